@@ -5,7 +5,13 @@ import json
 from dotenv import load_dotenv
 import os
 import re
+import hashlib
+import threading
+from collections import defaultdict, deque
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
 from datetime import datetime, timedelta
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
 from cryptography.fernet import Fernet
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.helpers import escape_markdown
@@ -109,6 +115,11 @@ KID_URL = BASE_URL+'api/rest/kid'
 EVENT_URL = BASE_URL+'api/rest/events' # запрос данных по программе(названиеб возраст ссылка)
 EVENTGROUP_URL = BASE_URL+'api/rest/eventGroups' # данные о группах в рамках программы
 EVENTGROUPSCHEDULE_URL = BASE_URL+'api/rest/eventGroupSchedule'
+
+# Трассировка запросов к CRM для профилирования без доступа к сайту
+# HTTP_TRACE_MODE: record — писать все запросы/ответы в файл, replay — отдавать их из файла
+HTTP_TRACE_MODE = os.getenv("HTTP_TRACE_MODE", "").strip().lower()
+HTTP_TRACE_FILE = os.getenv("HTTP_TRACE_FILE", "http_trace.jsonl")
 # Заголовки, имитирующие браузер
 HEADERS = {
     'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
@@ -152,10 +163,177 @@ def decrypt_password(encrypted_password: bytes) -> str:
     return fernet.decrypt(encrypted_password).decode()
 
 
+# --- Трассировка HTTP (запись / воспроизведение) ---
+# Поля с учётными данными, которые не должны попадать в файл трассировки
+TRACE_SECRET_KEYS = {'password', 'access_token', 'refresh_token'}
+
+
+def _redact_secrets(data):
+    if isinstance(data, dict):
+        return {k: '***' if k in TRACE_SECRET_KEYS and v else _redact_secrets(v) for k, v in data.items()}
+    if isinstance(data, list):
+        return [_redact_secrets(item) for item in data]
+    return data
+
+
+def _trace_body(body) -> str | None:
+    # Пароль и токены в файл трассировки не пишем
+    if body is None:
+        return None
+    if isinstance(body, bytes):
+        body = body.decode('utf-8', 'replace')
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return body
+    return json.dumps(_redact_secrets(data), ensure_ascii=False, separators=(',', ':'))
+
+
+def _trace_key(request) -> str:
+    # Убираем _dc (метка времени против кэша), иначе одинаковые запросы не совпадут
+    method = request.method.upper()
+    parts = urlsplit(request.url)
+    query = urlencode([(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if k != '_dc'])
+    key = f"{method} {urlunsplit(parts._replace(query=query))}"
+    # Тело POST/PUT/PATCH различает запросы к одному URL (вход разных пользователей, комментарии)
+    if method in ('POST', 'PUT', 'PATCH'):
+        body = _trace_body(request.body) or ''
+        key += ' #' + hashlib.sha256(body.encode('utf-8')).hexdigest()[:16]
+    return key
+
+
+class RecordingAdapter(HTTPAdapter):
+    # Выполняет запрос как обычно и дописывает запрос/ответ в HTTP_TRACE_FILE
+    _lock = threading.Lock()
+
+    def send(self, request, **kwargs):
+        started = time.time()
+        started_perf = time.perf_counter()
+        record = {
+            'key': _trace_key(request),
+            'ts': round(started, 3),
+            'request': _trace_body(request.body),
+        }
+        try:
+            response = super().send(request, **kwargs)
+            # response.elapsed не включает загрузку тела, поэтому меряем сами после чтения content
+            content = response.content
+        except requests.RequestException as e:
+            # Таймауты и обрывы тоже пишем, чтобы при воспроизведении они повторились
+            record['elapsed'] = round(time.perf_counter() - started_perf, 4)
+            record['error'] = type(e).__name__
+            self._write(record)
+            raise
+        record['elapsed'] = round(time.perf_counter() - started_perf, 4)
+        record['status'] = response.status_code
+        record['content_type'] = response.headers.get('Content-Type')
+        record['body'] = _trace_body(content)
+        self._write(record)
+        return response
+
+    def _write(self, record: dict):
+        try:
+            line = json.dumps(record, ensure_ascii=False, separators=(',', ':'))
+            with self._lock:
+                with open(HTTP_TRACE_FILE, 'a', encoding='utf-8') as f:
+                    f.write(line + '\n')
+        except Exception as e:
+            # Запрос к сайту уже выполнен — ошибка записи не должна выглядеть как ошибка подключения
+            logger.warning(f"Не удалось записать трассировку в {HTTP_TRACE_FILE}: {e}")
+
+
+class ReplayAdapter(BaseAdapter):
+    # Отдаёт записанные ответы (и ошибки) по ключу «метод + URL без _dc [+ хэш тела]» с исходными задержками
+    def __init__(self, path: str):
+        super().__init__()
+        self._records = defaultdict(deque)
+        self._lock = threading.Lock()
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    record = json.loads(line)
+                    self._records[record['key']].append(record)
+        logger.info(f"Загружено записей трассировки: {sum(len(q) for q in self._records.values())}")
+
+    def send(self, request, **kwargs):
+        key = _trace_key(request)
+        with self._lock:
+            queue = self._records.get(key)
+            if not queue:
+                raise requests.ConnectionError(f"Нет записи для {key}")
+            # Повторяющиеся запросы получают ответы по порядку, последний отдаём повторно
+            record = queue.popleft() if len(queue) > 1 else queue[0]
+
+        # Имитируем исходное время ответа (запросы в обработчиках блокирующие)
+        time.sleep(record['elapsed'])
+
+        if record.get('error'):
+            error_cls = getattr(requests.exceptions, record['error'], None)
+            if not (isinstance(error_cls, type) and issubclass(error_cls, requests.RequestException)):
+                error_cls = requests.ConnectionError
+            raise error_cls(f"Записанная ошибка для {key}", request=request)
+
+        response = requests.Response()
+        response.status_code = record['status']
+        response._content = record['body'].encode('utf-8')
+        response.encoding = 'utf-8'
+        response.headers = CaseInsensitiveDict()
+        if record.get('content_type'):
+            response.headers['Content-Type'] = record['content_type']
+        response.url = request.url
+        response.request = request
+        response.elapsed = timedelta(seconds=record['elapsed'])
+        response.connection = self
+        return response
+
+    def close(self):
+        pass
+
+
+_trace_adapter = None
+
+
+def init_http_trace() -> bool:
+    # Вызывается один раз при старте: проверяем режим и заранее загружаем файл для replay
+    global _trace_adapter
+    if not HTTP_TRACE_MODE:
+        return True
+    if HTTP_TRACE_MODE == 'record':
+        # Один запуск — один файл, иначе replay смешает ответы разных сессий
+        try:
+            open(HTTP_TRACE_FILE, 'w', encoding='utf-8').close()
+        except OSError as e:
+            logger.error(f"Не удалось создать файл трассировки {HTTP_TRACE_FILE}: {e}")
+            return False
+        _trace_adapter = RecordingAdapter()
+        logger.info(f"Трассировка HTTP: запись в {HTTP_TRACE_FILE}")
+        return True
+    if HTTP_TRACE_MODE == 'replay':
+        # Один адаптер на все сессии, чтобы записи не отдавались повторно
+        try:
+            _trace_adapter = ReplayAdapter(HTTP_TRACE_FILE)
+        except Exception as e:
+            logger.error(f"Не удалось загрузить трассировку {HTTP_TRACE_FILE}: {e}")
+            return False
+        logger.info(f"Трассировка HTTP: воспроизведение из {HTTP_TRACE_FILE}")
+        return True
+    logger.error(f"Неизвестный HTTP_TRACE_MODE: {HTTP_TRACE_MODE!r} (ожидается record или replay)")
+    return False
+
+
+def attach_http_trace(session: requests.Session):
+    if _trace_adapter is None:
+        return
+    session.mount('http://', _trace_adapter)
+    session.mount('https://', _trace_adapter)
+
+
 # --- Создание авторизованной сессии ---
 def create_authenticated_session(email: str, password: str) -> requests.Session | None:
     session = requests.Session()
     session.headers.update(HEADERS)
+    attach_http_trace(session)
 
     try:
         response = session.post(LOGIN_URL, json={'email': email, 'password': password}, timeout=10)
@@ -642,6 +820,8 @@ def restore_all_sessions():
 # === Запуск бота ===
 def main():
     global user_data
+    if not init_http_trace():
+        return
     user_data = load_user_data()  # 🔁 Загружаем данные при старте
     print(f"Загружено пользователей: {len(user_data)}")
 